@@ -2,42 +2,95 @@
 import logging
 import json
 from odoo import models, api, _
-from odoo.tools import float_compare, float_is_zero
+from odoo.tools import float_compare, float_round
+from odoo.tools.sql import create_index
 
 _logger = logging.getLogger(__name__)
 
+# Estados en los que un move todavía puede reservarse vía WholeLot.
+_ACTIONABLE_STATES = frozenset(('confirmed', 'partially_available', 'waiting'))
+
 
 class StockMove(models.Model):
     _inherit = 'stock.move'
 
+    def init(self):
+        super().init()
+        # La propagación post-validación y los re-chequeos del despacho
+        # filtran moves por estados reservables; el índice parcial cubre
+        # exactamente esa selectividad sin engordar con moves done/cancel.
+        create_index(
+            self._cr,
+            'stock_move_whole_lot_state_idx',
+            self._table,
+            ['state'],
+            where="state IN ('confirmed', 'partially_available', 'waiting')",
+        )
+
     # ═══════════════════════════════════════════════════════════════════════════
     # DETECCIÓN DE ESTRATEGIA
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _get_whole_lot_strategy_type(self):
-        """Returns: False, 'whole_lot', or 'whole_lot_partial'."""
-        self.ensure_one()
+    def _get_whole_lot_strategy_type(self, cache=None):
+        """Returns: False, 'whole_lot', or 'whole_lot_partial'.
+
+        `cache` es un dict opcional {(product_id, location_id): resultado}
+        que el caller comparte entre moves del mismo batch para no
+        re-evaluar categoría/ubicaciones de pares repetidos.
+
+        Se asume `self` singleton: todos los callers iteran move a move
+        dentro de loops propios del módulo.
+        """
         product = self.product_id
         if product.tracking not in ('lot', 'serial'):
             return False
 
+        cache_key = (product.id, self.location_id.id)
+        if cache is not None and cache_key in cache:
+            return cache[cache_key]
+
+        result = False
         if product.categ_id.removal_strategy_id:
             method = product.categ_id.removal_strategy_id.method
             if method in ('whole_lot', 'whole_lot_partial'):
-                return method
-
-        location = self.location_id
-        while location:
-            if location.removal_strategy_id:
-                method = location.removal_strategy_id.method
-                if method in ('whole_lot', 'whole_lot_partial'):
-                    return method
-            location = location.location_id
-        return False
+                result = method
+
+        if not result:
+            location = self.location_id
+            loc_key = ('loc', location.id)
+            if cache is not None and loc_key in cache:
+                result = cache[loc_key]
+            else:
+                # parent_path ya contiene toda la cadena de ancestros
+                # (root -> hoja): un solo browse en lugar de una consulta
+                # por nivel.
+                if location.parent_path:
+                    ancestor_ids = [int(loc_id) for loc_id in location.parent_path.split('/') if loc_id]
+                    ancestors = self.env['stock.location'].browse(ancestor_ids)
+                else:
+                    ancestors = location
+                visited_ids = []
+                for loc in reversed(ancestors):
+                    visited_ids.append(loc.id)
+                    if loc.removal_strategy_id:
+                        method = loc.removal_strategy_id.method
+                        if method in ('whole_lot', 'whole_lot_partial'):
+                            result = method
+                            break
+                if cache is not None:
+                    # El resultado de la caminata vale para cada ubicación
+                    # visitada (su propia caminata es un sufijo de esta):
+                    # moves hermanos en sub-ubicaciones resuelven en O(1).
+                    for visited_id in visited_ids:
+                        cache[('loc', visited_id)] = result
+
+        if cache is not None:
+            cache[cache_key] = result
+        return result
 
-    def _should_use_whole_lot_strategy(self):
+    def _should_use_whole_lot_strategy(self, cache=None):
         """Returns True if ANY of the whole_lot strategies applies."""
-        return bool(self._get_whole_lot_strategy_type())
+        return bool(self._get_whole_lot_strategy_type(cache=cache))
 
     # ═══════════════════════════════════════════════════════════════════════════
     # HOOK _action_assign
@@ -58,13 +111,42 @@ class StockMove(models.Model):
         if self.env.context.get('skip_whole_lot_strategy'):
             return super()._action_assign(force_qty=force_qty)
 
-        whole_lot_moves = self.env['stock.move']
-        regular_moves = self.env['stock.move']
+        # La gran mayoría de los pickings no contiene productos con
+        # seguimiento por lote/serie: en ese caso ir directo a la reserva
+        # estándar sin pagar la clasificación ni los prefetch del despacho.
+        if not any(tracking in ('lot', 'serial')
+                   for tracking in self.product_id.mapped('tracking')):
+            return super()._action_assign(force_qty=force_qty)
 
-        for move in self:
-            if move.state not in ('confirmed', 'partially_available', 'waiting') \
-                    or not move._should_use_whole_lot_strategy():
-                regular_moves |= move
+        # Warm prefetch: el loop de despacho consulta el estado de los moves
+        # de origen (deferral + logging); un solo fetch agrupado evita una
+        # lectura por move/origen. Ídem para las cadenas de decisión de
+        # estrategia: estrategias de categoría y parent_path de ubicaciones.
+        self.move_orig_ids.fetch(['state'])
+        self.product_id.categ_id.removal_strategy_id.fetch(['method'])
+        self.location_id.fetch(['parent_path', 'removal_strategy_id'])
+
+        # Acumular ids en listas y hacer un solo browse al final: la unión
+        # de recordsets (|=) por move es O(N²) en pickings grandes.
+        whole_lot_ids = []
+        regular_ids = []
+        strategy_cache = {}
+
+        # stock.move es una tabla ancha: iterar sin prefetch implícito para
+        # que un acceso suelto traiga solo su columna. Los campos que el
+        # loop sí necesita se cargan explícitamente en un fetch.
+        dispatch_moves = self.with_context(prefetch_fields=False)
+        dispatch_moves.fetch(['state', 'product_id', 'move_orig_ids',
+                              'picking_id', 'sale_line_id', 'location_id'])
+
+        for move in dispatch_moves:
+            # El chequeo de tracking va primero: es una lectura prefetched y
+            # descarta los moves no rastreados de un batch mixto sin pasar
+            # por la resolución de estrategia.
+            if move.state not in _ACTIONABLE_STATES \
+                    or move.product_id.tracking not in ('lot', 'serial') \
+                    or not move._should_use_whole_lot_strategy(cache=strategy_cache):
+                regular_ids.append(move.id)
                 continue
 
             sol = move.sale_line_id
@@ -77,20 +159,32 @@ class StockMove(models.Model):
                 continue
 
             if move.move_orig_ids and not self.env.context.get('force_whole_lot_assign'):
-                _logger.info(
-                    "WholeLot: Deferring reservation for %s (picking %s) - "
-                    "has %d origin move(s), states: %s",
-                    move.product_id.display_name,
-                    move.picking_id.name if move.picking_id else 'N/A',
-                    len(move.move_orig_ids),
-                    [m.state for m in move.move_orig_ids]
-                )
+                # La lista de estados se construye solo si INFO está activo.
+                if _logger.isEnabledFor(logging.INFO):
+                    picking = move.picking_id
+                    _logger.info(
+                        "WholeLot: Deferring reservation for %s (picking %s) - "
+                        "has %d origin move(s), states: %s",
+                        move.product_id.display_name,
+                        picking.name if picking else 'N/A',
+                        len(move.move_orig_ids),
+                        [m.state for m in move.move_orig_ids]
+                    )
                 continue
 
-            whole_lot_moves |= move
+            whole_lot_ids.append(move.id)
+
+        regular_moves = self.browse(regular_ids)
+        whole_lot_moves = self.browse(whole_lot_ids)
 
         if regular_moves:
             super(StockMove, regular_moves)._action_assign(force_qty=force_qty)
+            # La reserva estándar puede haber tocado moves encadenados del
+            # mismo batch: descartar los que ya quedaron asignados para no
+            # pagarles un escaneo de quants completo.
+            whole_lot_moves = whole_lot_moves.filtered(
+                lambda m: m.state in _ACTIONABLE_STATES
+            )
 
         if whole_lot_moves:
             _logger.info(
@@ -105,13 +199,56 @@ class StockMove(models.Model):
     # HELPERS COMPARTIDOS
     # ═══════════════════════════════════════════════════════════════════════════
 
+    # Resuelto una sola vez por registry: nombre del campo de cantidad
+    # reservada en stock.move.line según la versión de stock instalada.
+    _whole_lot_ml_qty_field_name = None
+
+    @api.model
+    def _whole_lot_ml_qty_field(self):
+        cls = type(self)
+        if cls._whole_lot_ml_qty_field_name is None:
+            ml_fields = self.env['stock.move.line']._fields
+            cls._whole_lot_ml_qty_field_name = (
+                'reserved_uom_qty' if 'reserved_uom_qty' in ml_fields else 'quantity'
+            )
+        return cls._whole_lot_ml_qty_field_name
+
+    # Ídem: campos opcionales de selección de lotes presentes en
+    # sale.order.line en esta base (el set instalado no cambia en runtime).
+    _whole_lot_sol_fields = None
+
+    @api.model
+    def _whole_lot_sol_field_set(self, sol):
+        cls = type(self)
+        if cls._whole_lot_sol_fields is None:
+            cls._whole_lot_sol_fields = frozenset(
+                field for field in ('lot_ids', 'x_selected_lots', 'x_lot_breakdown_json')
+                if field in sol._fields
+            )
+        return cls._whole_lot_sol_fields
+
+    # Ídem: si stock.move.line expone 'quantity' (qty efectiva reservada).
+    _whole_lot_ml_has_quantity = None
+
+    @api.model
+    def _whole_lot_ml_reads_quantity(self):
+        cls = type(self)
+        if cls._whole_lot_ml_has_quantity is None:
+            cls._whole_lot_ml_has_quantity = (
+                'quantity' in self.env['stock.move.line']._fields
+            )
+        return cls._whole_lot_ml_has_quantity
+
     def _sol_has_manual_lot_selection(self, sol):
         """Verifica si una línea de venta tiene lotes seleccionados manualmente."""
-        if hasattr(sol, 'lot_ids') and sol.lot_ids:
+        # Set de campos instalados resuelto una vez por registry, en vez de
+        # hasattr (que pasa por __getattr__ del recordset en cada llamada).
+        sol_fields = self._whole_lot_sol_field_set(sol)
+        if 'lot_ids' in sol_fields and sol.lot_ids:
             return True
-        if hasattr(sol, 'x_selected_lots') and sol.x_selected_lots:
+        if 'x_selected_lots' in sol_fields and sol.x_selected_lots:
             return True
-        if hasattr(sol, 'x_lot_breakdown_json') and sol.x_lot_breakdown_json:
+        if 'x_lot_breakdown_json' in sol_fields and sol.x_lot_breakdown_json:
             try:
                 json_data = sol.x_lot_breakdown_json
                 if isinstance(json_data, str):
@@ -125,47 +262,105 @@ class StockMove(models.Model):
     def _get_reserved_qty(self, move):
         """Get the currently reserved quantity for a move in its product UoM."""
         reserved = 0.0
+        product_uom = move.product_id.uom_id
+        # Factor de conversión por UoM de origen: se resuelve una sola vez
+        # por UoM distinta en lugar de un _compute_quantity por línea.
+        factors = {}
+        has_quantity = self._whole_lot_ml_reads_quantity()
         for ml in move.move_line_ids:
-            ml_qty = ml.quantity if 'quantity' in ml._fields else 0.0
-            reserved += ml.product_uom_id._compute_quantity(
-                ml_qty, move.product_id.uom_id,
-                rounding_method='HALF-UP'
-            )
+            ml_qty = ml.quantity if has_quantity else 0.0
+            ml_uom = ml.product_uom_id
+            if ml_uom == product_uom:
+                reserved += ml_qty
+                continue
+            factor = factors.get(ml_uom.id)
+            if factor is None:
+                factor = factors[ml_uom.id] = ml_uom._compute_quantity(
+                    1.0, product_uom, round=False
+                )
+            reserved += ml_qty * factor
         return reserved
 
+    @api.model
+    def _get_reserved_qty_batch(self, moves):
+        """Versión agrupada de _get_reserved_qty: un solo _read_group por
+        (move, UoM de línea) para todo el batch, con factores de conversión
+        cacheados por par de UoMs."""
+        reserved_by_move = dict.fromkeys(moves.ids, 0.0)
+        if not moves or not self._whole_lot_ml_reads_quantity():
+            return reserved_by_move
+        factors = {}
+        grouped = self.env['stock.move.line']._read_group(
+            [('move_id', 'in', moves.ids)],
+            ['move_id', 'product_uom_id'],
+            ['quantity:sum'],
+        )
+        for move, ml_uom, qty_sum in grouped:
+            qty = qty_sum or 0.0
+            product_uom = move.product_id.uom_id
+            if ml_uom != product_uom:
+                factor_key = (ml_uom.id, product_uom.id)
+                factor = factors.get(factor_key)
+                if factor is None:
+                    factor = factors[factor_key] = ml_uom._compute_quantity(
+                        1.0, product_uom, round=False
+                    )
+                qty *= factor
+            reserved_by_move[move.id] += qty
+        return reserved_by_move
+
     def _get_already_delivered_lot_ids(self, sale_line):
         """Obtiene IDs de lotes ya entregados (moves done) para una SO line."""
         delivered_lot_ids = set()
         if not sale_line:
             return delivered_lot_ids
-        done_moves = sale_line.move_ids.filtered(lambda m: m.state == 'done')
-        for move in done_moves:
+        # Iteración directa sin filtered(): evita materializar un recordset
+        # intermedio por llamada (los estados ya están prefetched en batch).
+        for move in sale_line.move_ids:
+            if move.state != 'done':
+                continue
             for ml in move.move_line_ids:
                 if ml.lot_id:
                     delivered_lot_ids.add(ml.lot_id.id)
         if delivered_lot_ids:
             _logger.info(
                 "WholeLot: Found %d already-delivered lots for SO Line %s: %s",
-                len(delivered_lot_ids), sale_line.id, list(delivered_lot_ids)
+                len(delivered_lot_ids), sale_line.id, delivered_lot_ids
             )
         return delivered_lot_ids
 
-    def _get_currently_reserved_lot_ids(self, sale_line, exclude_move=None):
+    def _get_reserved_lot_ids_by_move(self, sale_line):
+        """Lotes reservados por move activo de la SO line: {move_id: set(lot_ids)}.
+
+        Separado para poder computarse una sola vez por SO line y resolver
+        las exclusiones por move con lookups en memoria.
+        """
+        by_move = {}
+        if not sale_line:
+            return by_move
+        for move in sale_line.move_ids:
+            if move.state not in ('assigned', 'partially_available'):
+                continue
+            lot_ids = {ml.lot_id.id for ml in move.move_line_ids if ml.lot_id}
+            if lot_ids:
+                by_move[move.id] = lot_ids
+        return by_move
+
+    def _get_currently_reserved_lot_ids(self, sale_line, exclude_move=None, by_move=None):
         """Obtiene IDs de lotes reservados en moves activos de la misma SO line."""
         reserved_lot_ids = set()
         if not sale_line:
             return reserved_lot_ids
-        active_moves = sale_line.move_ids.filtered(
-            lambda m: m.state in ('assigned', 'partially_available') and m != exclude_move
-        )
-        for move in active_moves:
-            for ml in move.move_line_ids:
-                if ml.lot_id:
-                    reserved_lot_ids.add(ml.lot_id.id)
+        if by_move is None:
+            by_move = self._get_reserved_lot_ids_by_move(sale_line)
+        exclude_id = exclude_move.id if exclude_move else None
+        for move_id, lot_ids in by_move.items():
+            if move_id != exclude_id:
+                reserved_lot_ids |= lot_ids
         if reserved_lot_ids:
             _logger.info(
                 "WholeLot: Found %d lots reserved in sibling moves for SO Line %s: %s",
-                len(reserved_lot_ids), sale_line.id, list(reserved_lot_ids)
+                len(reserved_lot_ids), sale_line.id, reserved_lot_ids
             )
         return reserved_lot_ids
 
@@ -182,35 +377,42 @@ class StockMove(models.Model):
         if not sol:
             return result
 
+        sol_fields = self._whole_lot_sol_field_set(sol)
+
         # FUENTE 1: x_lot_breakdown_json (ÚNICA con cantidades explícitas)
-        if hasattr(sol, 'x_lot_breakdown_json') and sol.x_lot_breakdown_json:
+        if 'x_lot_breakdown_json' in sol_fields and sol.x_lot_breakdown_json:
             try:
                 json_data = sol.x_lot_breakdown_json
                 if isinstance(json_data, str):
                     json_data = json.loads(json_data)
                 if isinstance(json_data, dict):
                     for k, v in json_data.items():
-                        if str(k).isdigit():
+                        # int(k) directo en lugar de str(k).isdigit() + int():
+                        # una conversión por clave en vez de dos pasadas.
+                        try:
                             lot_id = int(k)
-                            result['lot_ids'].add(lot_id)
-                            try:
-                                result['breakdown'][lot_id] = float(v)
-                            except (ValueError, TypeError):
-                                pass
+                        except (ValueError, TypeError):
+                            continue
+                        result['lot_ids'].add(lot_id)
+                        try:
+                            result['breakdown'][lot_id] = float(v)
+                        except (ValueError, TypeError):
+                            pass
             except Exception as e:
-                _logger.warning(f"WholeLot: Failed to parse x_lot_breakdown_json: {e}")
+                _logger.warning("WholeLot: Failed to parse x_lot_breakdown_json: %s", e)
 
         # FUENTE 2: x_selected_lots
-        if hasattr(sol, 'x_selected_lots') and sol.x_selected_lots:
+        if 'x_selected_lots' in sol_fields and sol.x_selected_lots:
             try:
-                cart_lot_ids = sol.x_selected_lots.mapped('lot_id').ids
-                result['lot_ids'].update(cart_lot_ids)
+                # Traversal directo del many2one + _ids: evita el mapped()
+                # y la validación de NewIds de .ids en registros ya en DB.
+                result['lot_ids'].update(sol.x_selected_lots.lot_id._ids)
             except Exception:
                 pass
 
         # FUENTE 3: lot_ids
-        if hasattr(sol, 'lot_ids') and sol.lot_ids:
-            result['lot_ids'].update(sol.lot_ids.ids)
+        if 'lot_ids' in sol_fields and sol.lot_ids:
+            result['lot_ids'].update(sol.lot_ids._ids)
 
         return result
 
@@ -219,49 +421,126 @@ class StockMove(models.Model):
     # ═══════════════════════════════════════════════════════════════════════════
 
     def _assign_whole_lots(self):
-        """Dispatch: bifurca entre whole_lot (lotes completos) y whole_lot_partial."""
+        """Dispatch: bifurca entre whole_lot (lotes completos) y whole_lot_partial.
+
+        La disponibilidad por lote se consulta UNA sola vez por par
+        (producto, ubicación) y se comparte entre todos los moves del batch;
+        las reservas decrementan el cache en memoria para que los moves
+        siguientes vean la disponibilidad real sin re-consultar quants.
+        """
         Quant = self.env['stock.quant']
+        # Caches {(product_id, location_id): ...} compartidos en el batch.
+        lots_cache = {}
+        strategy_cache = {}
+        # Caches por SO line: lotes entregados y mapa de reservas por move.
+        delivered_cache = {}
+        reserved_map_cache = {}
+        # Transiciones de estado agrupadas: un write por estado destino.
+        to_assigned_ids = []
+        to_partial_ids = []
+        # Vals de move lines acumulados para todo el batch: un solo create.
+        ml_vals_list = []
+
+        # Cantidad ya reservada resuelta para todo el batch con un solo
+        # _read_group, en lugar de recorrer move_line_ids move a move.
+        reserved_by_move = self._get_reserved_qty_batch(self)
+
+        # Campos de producto leídos dentro del loop (UoM, código para logs):
+        # una consulta por campo para todo el batch.
+        self.product_id.fetch(['uom_id', 'default_code', 'display_name'])
+
+        # Ídem para la selección de lotes de las SO lines del batch: una
+        # consulta por campo en lugar de una por move dentro del loop.
+        sale_lines = self.sale_line_id
+        if sale_lines:
+            sol_fetch_fields = list(self._whole_lot_sol_field_set(sale_lines))
+            if sol_fetch_fields:
+                sale_lines.fetch(sol_fetch_fields)
+            # Los moves hermanos de cada SO line y sus líneas se recorren al
+            # calcular lotes ya entregados / reservados: cargarlos agrupados.
+            sibling_moves = sale_lines.move_ids
+            if sibling_moves:
+                sibling_moves.fetch(['state'])
+                sibling_moves.move_line_ids.fetch(['lot_id'])
+
+        # Demanda en UoM de producto precalculada para todo el batch, con el
+        # factor de conversión resuelto una vez por par de UoMs.
+        uom_factors = {}
+        demand_by_move = {}
+        for move in self:
+            product_uom = move.product_id.uom_id
+            if move.product_uom == product_uom:
+                demand_by_move[move.id] = move.product_uom_qty
+                continue
+            factor_key = (move.product_uom.id, product_uom.id)
+            factor = uom_factors.get(factor_key)
+            if factor is None:
+                factor = uom_factors[factor_key] = move.product_uom._compute_quantity(
+                    1.0, product_uom, round=False
+                )
+            demand_by_move[move.id] = float_round(
+                move.product_uom_qty * factor,
+                precision_rounding=product_uom.rounding,
+                rounding_method='HALF-UP',
+            )
 
         for move in self:
-            if move.state not in ('confirmed', 'partially_available', 'waiting'):
+            # Re-chequeo barato: el estado puede haber cambiado entre el
+            # despacho y este punto (p.ej. reservas de moves hermanos).
+            if move.state not in _ACTIONABLE_STATES:
                 continue
 
-            strategy = move._get_whole_lot_strategy_type()
+            strategy = move._get_whole_lot_strategy_type(cache=strategy_cache)
             if not strategy:
                 continue
 
             product = move.product_id
             rounding = product.uom_id.rounding
 
-            total_demand_move_uom = move.product_uom_qty
-            total_demand = move.product_uom._compute_quantity(
-                total_demand_move_uom, product.uom_id, rounding_method='HALF-UP'
-            )
+            total_demand = demand_by_move[move.id]
 
-            already_reserved = self._get_reserved_qty(move)
+            already_reserved = reserved_by_move.get(move.id, 0.0)
             need = total_demand - already_reserved
 
-            is_backorder = bool(move.picking_id and move.picking_id.backorder_id)
+            # picking se dereferencia una vez por move y se reutiliza en los
+            # logs y en los vals base de las líneas.
+            picking = move.picking_id
+            backorder_of = picking.backorder_id.name if picking and picking.backorder_id else ''
 
             _logger.info("=" * 80)
             _logger.info(
                 "WholeLot[%s]: Move %d [%s] @ %s%s",
                 strategy, move.id, product.default_code, move.location_id.display_name,
-                ' [BACKORDER of %s]' % move.picking_id.backorder_id.name if is_backorder else ''
+                ' [BACKORDER of %s]' % backorder_of if backorder_of else ''
             )
-            _logger.info(f"WholeLot: Demand: {total_demand:.2f}, Reserved: {already_reserved:.2f}, Need: {need:.2f}")
+            _logger.info("WholeLot: Demand: %.2f, Reserved: %.2f, Need: %.2f",
+                         total_demand, already_reserved, need)
 
-            if float_is_zero(need, precision_rounding=rounding) or \
-                    float_compare(need, 0, precision_rounding=rounding) <= 0:
+            # Comparación directa contra medio redondeo: equivale a
+            # float_compare(x, 0) <= 0 sin el costo de la llamada.
+            eps = rounding / 2.0
+            if need <= eps:
                 _logger.info("WholeLot: Need is zero, skipping.")
                 continue
 
-            available_lots = Quant._get_whole_lot_available_quants(
-                product, move.location_id
-            )
-
-            avail_debug = [f"{d['lot_id'].name} ({d['available_qty']:.2f})" for d in available_lots]
-            _logger.info(f"WholeLot: Physical Availability (Count: {len(available_lots)}): {avail_debug}")
+            cache_key = (product.id, move.location_id.id)
+            if cache_key not in lots_cache:
+                lots_cache[cache_key] = Quant._get_whole_lot_available_quants(
+                    product, move.location_id
+                )
+            # Los dicts son compartidos con el cache: filtrar los lotes ya
+            # agotados por reservas de moves anteriores del mismo batch.
+            available_lots = [
+                d for d in lots_cache[cache_key] if d['available_qty'] > eps
+            ]
+
+            # No construir el payload (toca lot.name por candidato) si el
+            # nivel INFO está deshabilitado.
+            if _logger.isEnabledFor(logging.INFO):
+                avail_debug = ["%s (%.2f)" % (d['lot_id'].name, d['available_qty'])
+                               for d in available_lots]
+                _logger.info("WholeLot: Physical Availability (Count: %d): %s",
+                             len(available_lots), avail_debug)
 
             if not available_lots:
                 _logger.warning(
@@ -272,10 +551,26 @@ class StockMove(models.Model):
 
             sol = move.sale_line_id
             selection = self._get_sol_lot_selection(sol)
-            already_delivered_ids = self._get_already_delivered_lot_ids(sol) if sol else set()
-            currently_reserved_ids = self._get_currently_reserved_lot_ids(sol, exclude_move=move) if sol else set()
+            # Los escaneos de moves hermanos (entregados / reservados) se
+            # resuelven una vez por SO line y se comparten entre los moves
+            # del batch; la exclusión por move se aplica sobre el mapa.
+            already_delivered_ids = set()
+            currently_reserved_ids = set()
+            if sol:
+                already_delivered_ids = delivered_cache.get(sol.id)
+                if already_delivered_ids is None:
+                    already_delivered_ids = delivered_cache[sol.id] = \
+                        self._get_already_delivered_lot_ids(sol)
+                by_move = reserved_map_cache.get(sol.id)
+                if by_move is None:
+                    by_move = reserved_map_cache[sol.id] = \
+                        self._get_reserved_lot_ids_by_move(sol)
+                currently_reserved_ids = self._get_currently_reserved_lot_ids(
+                    sol, exclude_move=move, by_move=by_move
+                )
 
-            allowed_lot_ids = set(selection['lot_ids'])
+            # Ya es un set recién construido para este move: usarlo directo.
+            allowed_lot_ids = selection['lot_ids']
             has_restriction = bool(allowed_lot_ids)
 
             if has_restriction:
@@ -284,7 +579,8 @@ class StockMove(models.Model):
                 if currently_reserved_ids:
                     allowed_lot_ids -= currently_reserved_ids
 
-                _logger.info(f"WholeLot: [RESTRICTION] Target Lot IDs after exclusions: {list(allowed_lot_ids)}")
+                _logger.info("WholeLot: [RESTRICTION] Target Lot IDs after exclusions: %s",
+                             allowed_lot_ids)
 
                 available_lots = [d for d in available_lots if d['lot_id'].id in allowed_lot_ids]
 
@@ -307,49 +603,65 @@ class StockMove(models.Model):
             # BIFURCACIÓN
             if strategy == 'whole_lot_partial':
                 total_reserved = self._reserve_whole_lot_partial(
-                    move, available_lots, selection['breakdown'], rounding
+                    move, available_lots, selection['breakdown'], rounding, ml_vals_list
                 )
             else:
                 total_reserved = self._reserve_whole_lot_complete(
-                    move, available_lots, need, rounding
+                    move, available_lots, need, rounding, ml_vals_list
                 )
 
-            if float_compare(total_reserved, 0, precision_rounding=rounding) > 0:
-                new_reserved = self._get_reserved_qty(move)
+            if total_reserved > eps:
+                # Acabamos de crear las líneas: lo reservado es lo que había
+                # más lo recién reservado, sin re-recorrer move_line_ids.
+                new_reserved = already_reserved + total_reserved
+                # float_compare se conserva aquí: el empate demanda/reserva
+                # cerca del redondeo decide el estado final del move.
                 cmp = float_compare(new_reserved, total_demand, precision_rounding=rounding)
                 if cmp >= 0:
-                    move.write({'state': 'assigned'})
+                    to_assigned_ids.append(move.id)
                     _logger.info("WholeLot: Move state updated to ASSIGNED")
                 elif move.state != 'partially_available':
-                    move.write({'state': 'partially_available'})
+                    to_partial_ids.append(move.id)
                     _logger.info("WholeLot: Move state updated to PARTIALLY AVAILABLE")
 
             _logger.info("=" * 80)
 
+        if ml_vals_list:
+            self.env['stock.move.line'].create(ml_vals_list)
+        if to_assigned_ids:
+            self.browse(to_assigned_ids).write({'state': 'assigned'})
+        if to_partial_ids:
+            self.browse(to_partial_ids).write({'state': 'partially_available'})
+
     # ═══════════════════════════════════════════════════════════════════════════
     # ESTRATEGIA 1: whole_lot (PLACAS)
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _reserve_whole_lot_complete(self, move, available_lots, need, rounding):
+    def _reserve_whole_lot_complete(self, move, available_lots, need, rounding, ml_vals_list):
         """Reserva lotes COMPLETOS (sin dividir). Usado por placas."""
         Quant = self.env['stock.quant']
         product = move.product_id
 
         selected = Quant._whole_lot_select_lots(available_lots, need, rounding)
         if not selected:
-            _logger.info(
-                "WholeLot[complete]: Could not select complete lots for demand %.2f. Candidates: %s",
-                need, [d['lot_id'].name for d in available_lots]
-            )
+            if _logger.isEnabledFor(logging.INFO):
+                _logger.info(
+                    "WholeLot[complete]: Could not select complete lots for demand %.2f. Candidates: %s",
+                    need, [d['lot_id'].name for d in available_lots]
+                )
             return 0.0
 
         total_reserved = 0.0
+        eps = rounding / 2.0
+        base_vals = self._prepare_whole_lot_base_ml_vals(move, product)
         for lot_data in selected:
             lot = lot_data['lot_id']
             qty = lot_data['available_qty']
-            if float_compare(qty, 0, precision_rounding=rounding) <= 0:
+            if qty <= eps:
                 continue
-            reserved = self._do_reserve_lot(move, lot, qty, product, rounding)
+            reserved = self._do_reserve_lot(move, lot, qty, product, rounding, ml_vals_list,
+                                            quants=lot_data['quants'], base_vals=base_vals)
+            lot_data['available_qty'] -= reserved
             total_reserved += reserved
         return total_reserved
 
@@ -357,10 +669,12 @@ class StockMove(models.Model):
     # ESTRATEGIA 2: whole_lot_partial (FORMATOS/PIEZAS)
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _reserve_whole_lot_partial(self, move, available_lots, breakdown, rounding):
+    def _reserve_whole_lot_partial(self, move, available_lots, breakdown, rounding, ml_vals_list):
         """Reserva cantidades PARCIALES según breakdown."""
         product = move.product_id
         total_reserved = 0.0
+        eps = rounding / 2.0
+        base_vals = self._prepare_whole_lot_base_ml_vals(move, product)
 
         for lot_data in available_lots:
             lot = lot_data['lot_id']
@@ -387,10 +701,13 @@ class StockMove(models.Model):
                         lot.name, qty_to_reserve
                     )
 
-            if float_compare(qty_to_reserve, 0, precision_rounding=rounding) <= 0:
+            if qty_to_reserve <= eps:
                 continue
 
-            reserved = self._do_reserve_lot(move, lot, qty_to_reserve, product, rounding)
+            reserved = self._do_reserve_lot(move, lot, qty_to_reserve, product, rounding,
+                                            ml_vals_list, quants=lot_data['quants'],
+                                            base_vals=base_vals)
+            lot_data['available_qty'] -= reserved
             total_reserved += reserved
 
         return total_reserved
@@ -399,29 +716,64 @@ class StockMove(models.Model):
     # RESERVA ATÓMICA (COMPARTIDA)
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _do_reserve_lot(self, move, lot, qty, product, rounding):
-        """Reserva `qty` del `lot` y crea el move_line. Returns: cantidad reservada."""
+    # La forma del retorno de _update_reserved_quantity depende de la
+    # versión de stock, no del registro: se detecta una vez por registry.
+    _update_reserved_returns_scalar = None
+
+    @api.model
+    def _extract_reserved_qty(self, result, requested_qty):
+        """Normaliza el retorno de _update_reserved_quantity entre versiones:
+        puede ser la cantidad reservada (float) o una lista de tuplas
+        (quant, qty). Si la forma es desconocida, se asume la cantidad pedida."""
+        cls = type(self)
+        if cls._update_reserved_returns_scalar is None:
+            cls._update_reserved_returns_scalar = isinstance(result, (int, float))
+        if cls._update_reserved_returns_scalar:
+            return float(result)
+        try:
+            return sum(item[1] for item in result)
+        except (TypeError, IndexError):
+            return requested_qty
+
+    def _do_reserve_lot(self, move, lot, qty, product, rounding, ml_vals_list,
+                        quants=None, base_vals=None):
+        """Reserva `qty` del `lot` y acumula los vals del move_line en
+        `ml_vals_list` (el caller crea las líneas en lote). Returns: cantidad reservada."""
         Quant = self.env['stock.quant']
+        eps = rounding / 2.0
+
+        # LBYL: validar la disponibilidad con los quants ya en memoria (el
+        # cache ORM refleja las reservas previas de esta transacción) antes
+        # de intentar reservar, en lugar de dejar que la excepción esperada
+        # pague el costo en el camino común.
+        if quants is not None:
+            available_free = sum(q.quantity - q.reserved_quantity for q in quants)
+            if available_free < qty - eps:
+                if available_free <= eps:
+                    _logger.warning(
+                        "WholeLot: Lot '%s' has no free quantity left, skipping.",
+                        lot.name,
+                    )
+                    return 0.0
+                _logger.warning(
+                    "WholeLot: Clamping reservation of lot '%s' to available %.2f (wanted %.2f)",
+                    lot.name, available_free, qty,
+                )
+                qty = available_free
 
         try:
-            reserved_before = sum(
-                q.reserved_quantity
-                for q in Quant._gather(product, move.location_id, lot_id=lot, strict=False)
-            )
-
-            Quant._update_reserved_quantity(
+            result = Quant._update_reserved_quantity(
                 product, move.location_id, qty, lot_id=lot, strict=False
             )
+            actual_reserved = self._extract_reserved_qty(result, qty)
 
-            reserved_after = sum(
-                q.reserved_quantity
-                for q in Quant._gather(product, move.location_id, lot_id=lot, strict=False)
-            )
-
-            actual_reserved = reserved_after - reserved_before
-
-            if float_compare(actual_reserved, 0, precision_rounding=rounding) > 0:
-                self._create_whole_lot_move_line(move, lot, actual_reserved, product)
+            if actual_reserved > rounding / 2.0:
+                ml_vals_list.append(
+                    self._prepare_whole_lot_move_line_vals(
+                        move, lot, actual_reserved, product,
+                        quants=quants, base_vals=base_vals
+                    )
+                )
                 _logger.info(
                     "WholeLot: SUCCESS - Reserved lot '%s' (%.2f %s)",
                     lot.name, actual_reserved, product.uom_id.name
@@ -433,43 +785,64 @@ class StockMove(models.Model):
                 )
                 return 0.0
         except Exception as e:
-            _logger.error("WholeLot: EXCEPTION reserving lot '%s': %s",
-                          lot.name if lot else 'N/A', str(e))
+            # Sin exc_info en el nivel visible: formatear el traceback por
+            # cada fallo de reserva es caro bajo contención. El detalle
+            # completo queda disponible en DEBUG.
+            _logger.error("WholeLot: EXCEPTION reserving lot '%s': %s: %s",
+                          lot.name if lot else 'N/A', type(e).__name__, e)
+            _logger.debug("WholeLot: reservation failure traceback", exc_info=True)
             return 0.0
 
-    def _create_whole_lot_move_line(self, move, lot, quantity, product):
-        """Create a stock.move.line for a whole-lot reservation."""
-        uom_qty = product.uom_id._compute_quantity(
-            quantity, move.product_uom, rounding_method='HALF-UP'
-        )
-
+    def _prepare_whole_lot_base_ml_vals(self, move, product):
+        """Parte de los vals de move line invariante por move: se construye
+        una sola vez y se reutiliza para cada lote reservado del move."""
         vals = {
             'move_id': move.id,
             'product_id': product.id,
             'product_uom_id': move.product_uom.id,
             'location_id': move.location_id.id,
             'location_dest_id': move.location_dest_id.id,
-            'lot_id': lot.id if lot else False,
-            'lot_name': lot.name if lot else False,
             'company_id': move.company_id.id or self.env.company.id,
         }
-
-        if 'reserved_uom_qty' in self.env['stock.move.line']._fields:
-            vals['reserved_uom_qty'] = uom_qty
+        picking = move.picking_id
+        if picking:
+            vals['picking_id'] = picking.id
+        return vals
+
+    def _prepare_whole_lot_move_line_vals(self, move, lot, quantity, product,
+                                          quants=None, base_vals=None):
+        """Prepare the stock.move.line vals for a whole-lot reservation.
+
+        `quants` permite reutilizar los quants ya reunidos por el caller
+        para resolver paquete/propietario sin un _gather adicional;
+        `base_vals` la plantilla por move de _prepare_whole_lot_base_ml_vals.
+        """
+        if move.product_uom == product.uom_id:
+            uom_qty = quantity
         else:
-            vals['quantity'] = uom_qty
+            uom_qty = product.uom_id._compute_quantity(
+                quantity, move.product_uom, rounding_method='HALF-UP'
+            )
 
-        if move.picking_id:
-            vals['picking_id'] = move.picking_id.id
+        if base_vals is None:
+            base_vals = self._prepare_whole_lot_base_ml_vals(move, product)
+        vals = dict(base_vals)
+        vals['lot_id'] = lot.id if lot else False
+        vals['lot_name'] = lot.name if lot else False
+        vals[self._whole_lot_ml_qty_field()] = uom_qty
 
-        quants = self.env['stock.quant']._gather(
-            product, move.location_id, lot_id=lot, strict=False
-        )
+        if quants is None:
+            quants = self.env['stock.quant']._gather(
+                product, move.location_id, lot_id=lot, strict=False
+            )
         if quants:
-            first_quant = quants[0]
-            if first_quant.package_id:
-                vals['package_id'] = first_quant.package_id.id
-            if first_quant.owner_id:
-                vals['owner_id'] = first_quant.owner_id.id
-
-        return self.env['stock.move.line'].create(vals)
\ No newline at end of file
+            # Con los quants ya en memoria, elegir el de mayor disponible:
+            # más representativo que el primero arbitrario del gather y sin
+            # costo adicional de consultas.
+            best_quant = max(quants, key=lambda q: q.quantity - q.reserved_quantity)
+            if best_quant.package_id:
+                vals['package_id'] = best_quant.package_id.id
+            if best_quant.owner_id:
+                vals['owner_id'] = best_quant.owner_id.id
+
+        return vals
\ No newline at end of file
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from odoo import models
+from odoo.tools.sql import create_index
+
+
+class StockMoveLine(models.Model):
+    _inherit = 'stock.move.line'
+
+    def init(self):
+        super().init()
+        # Los cálculos de lotes entregados/reservados por SO line leen
+        # líneas por move con lote asignado; índice parcial análogo al de
+        # stock_quant para mantener esos lookups como Index Scan.
+        create_index(
+            self._cr,
+            'stock_move_line_whole_lot_lot_idx',
+            self._table,
+            ['move_id', 'lot_id'],
+            where='lot_id IS NOT NULL',
+        )
@@ -2,10 +2,15 @@
 import logging
 import json
 from odoo import models
-from odoo.tools import float_compare
+from odoo.tools import float_compare, float_round
+
+from .stock_move import _ACTIONABLE_STATES
 
 _logger = logging.getLogger(__name__)
 
+# Estados en los que un move de backorder todavía admite re-asignación.
+_BACKORDER_STATES = frozenset(('confirmed', 'partially_available', 'waiting', 'assigned'))
+
 
 class StockPicking(models.Model):
     _inherit = 'stock.picking'
@@ -15,11 +20,42 @@ class StockPicking(models.Model):
         validating_ids = self.ids
         res = super().button_validate()
 
-        for picking in self.browse(validating_ids):
-            if picking.state != 'done':
-                continue
-            picking._propagate_whole_lots_to_next_step()
-            picking._assign_whole_lots_to_backorder()
+        done_pickings = self.browse(validating_ids).filtered(
+            lambda p: p.state == 'done'
+        )
+        # Corto-circuito para la gran mayoría de pickings sin productos
+        # rastreados por lote/serie: WholeLot no puede aplicar ni aquí ni
+        # aguas abajo (la estrategia exige tracking), así que no se paga ni
+        # la búsqueda de backorders ni la propagación. No se filtra por la
+        # estrategia del propio picking porque la del siguiente paso puede
+        # venir de la ubicación destino.
+        done_pickings = done_pickings.filtered(
+            lambda p: any(
+                tracking in ('lot', 'serial')
+                for tracking in p.move_ids.product_id.mapped('tracking')
+            )
+        )
+        if done_pickings:
+            # Propagación en batch: una sola pasada de reserva para los
+            # moves diferidos de todos los pickings validados.
+            done_pickings._propagate_whole_lots_to_next_step()
+            # Backorders de todo el batch resueltos con un solo search y
+            # agrupados por picking padre en Python.
+            backorders = self.env['stock.picking'].search([
+                ('backorder_id', 'in', done_pickings.ids),
+                ('state', 'in', ('confirmed', 'waiting', 'assigned')),
+            ])
+            bo_ids_by_parent = {}
+            for backorder in backorders:
+                bo_ids_by_parent.setdefault(
+                    backorder.backorder_id.id, []
+                ).append(backorder.id)
+            for picking in done_pickings:
+                bo_ids = bo_ids_by_parent.get(picking.id)
+                if bo_ids:
+                    picking._assign_whole_lots_to_backorder(
+                        backorders.browse(bo_ids)
+                    )
 
         return res
 
@@ -28,33 +64,49 @@ class StockPicking(models.Model):
     # ═══════════════════════════════════════════════════════════════════════════
 
     def _propagate_whole_lots_to_next_step(self):
-        """Find downstream moves that were deferred and assign them."""
-        self.ensure_one()
-
-        next_moves = self.env['stock.move']
+        """Find downstream moves that were deferred and assign them.
+
+        Opera sobre todo el recordset: los moves destino de todos los
+        pickings validados se filtran y reservan en una sola pasada.
+        """
+        # Ids acumulados en estructuras planas y un solo browse: la unión de
+        # recordsets por move es O(N²) en pickings grandes.
+        next_move_ids = []
+        seen_ids = set()
         for move in self.move_ids:
             if move.state == 'done':
-                next_moves |= move.move_dest_ids
+                for dest_id in move.move_dest_ids._ids:
+                    if dest_id not in seen_ids:
+                        seen_ids.add(dest_id)
+                        next_move_ids.append(dest_id)
 
-        if not next_moves:
+        if not next_move_ids:
             return
 
-        deferred_moves = self.env['stock.move']
-        for move in next_moves:
-            if move.state not in ('confirmed', 'partially_available', 'waiting'):
-                continue
-            try:
-                if move._should_use_whole_lot_strategy():
-                    deferred_moves |= move
-            except Exception:
-                continue
-
-        if not deferred_moves:
+        deferred_ids = []
+        # Cache compartido {(product, location) / ubicación: estrategia}:
+        # los moves propagados suelen repetir pares producto/ubicación.
+        strategy_cache = {}
+        # Candidatos sin prefetch implícito: el filtro solo lee estado y la
+        # cadena de decisión de estrategia.
+        candidates = self.env['stock.move'].with_context(
+            prefetch_fields=False
+        ).browse(next_move_ids)
+        candidates.fetch(['state', 'product_id', 'location_id'])
+        # Sin try/except por move: la resolución de estrategia son lecturas
+        # de campos ya prefetched, sin efectos secundarios que aislar.
+        for move in candidates:
+            if move.state in _ACTIONABLE_STATES \
+                    and move._should_use_whole_lot_strategy(cache=strategy_cache):
+                deferred_ids.append(move.id)
+
+        if not deferred_ids:
             return
+        deferred_moves = self.env['stock.move'].browse(deferred_ids)
 
         _logger.info(
             "WholeLot: Post-validation propagation from %s -> %d deferred move(s)",
-            self.name, len(deferred_moves)
+            ', '.join(self.mapped('name')), len(deferred_moves)
         )
 
         deferred_moves.with_context(skip_whole_lot_strategy=True)._action_assign()
@@ -63,26 +115,56 @@ class StockPicking(models.Model):
     # ASIGNACIÓN AL BACKORDER
     # ═══════════════════════════════════════════════════════════════════════════
 
-    def _assign_whole_lots_to_backorder(self):
-        """Force-assign pending lots to backorder. Respeta whole_lot y whole_lot_partial."""
+    def _assign_whole_lots_to_backorder(self, backorder_pickings=None):
+        """Force-assign pending lots to backorder. Respeta whole_lot y whole_lot_partial.
+
+        `backorder_pickings` permite al caller (button_validate) pasar los
+        backorders ya buscados para todo el batch; si no se provee, se
+        buscan aquí.
+        """
         self.ensure_one()
 
-        backorder_pickings = self.env['stock.picking'].search([
-            ('backorder_id', '=', self.id),
-            ('state', 'in', ('confirmed', 'waiting', 'assigned')),
-        ])
+        if backorder_pickings is None:
+            backorder_pickings = self.env['stock.picking'].search([
+                ('backorder_id', '=', self.id),
+                ('state', 'in', ('confirmed', 'waiting', 'assigned')),
+            ])
 
         if not backorder_pickings:
             return
 
         Quant = self.env['stock.quant']
+        Move = self.env['stock.move']
+        ml_qty_field = Move._whole_lot_ml_qty_field()
+        ml_has_quantity = Move._whole_lot_ml_reads_quantity()
+        # Lotes ya entregados y selección validada memoizados por SO line.
+        delivered_cache = {}
+        selection_cache = {}
+
+        # Los moves hermanos de las SO lines del backorder se recorren al
+        # calcular lo entregado: cargar estados, lotes y campos de
+        # selección en batch.
+        bo_sale_lines = backorder_pickings.move_ids.sale_line_id
+        if bo_sale_lines:
+            bo_sale_lines.move_ids.fetch(['state'])
+            bo_sale_lines.move_ids.move_line_ids.fetch(['lot_id'])
+            sol_fetch_fields = list(Move._whole_lot_sol_field_set(bo_sale_lines))
+            if sol_fetch_fields:
+                bo_sale_lines.fetch(sol_fetch_fields)
+        # Transiciones de estado agrupadas: un write por estado destino.
+        to_assigned_ids = []
+        to_partial_ids = []
+        # Líneas acumuladas y creadas en un solo create() al final.
+        ml_vals_list = []
+        # Cache de estrategia compartido entre los moves del backorder.
+        strategy_cache = {}
 
         for bo_picking in backorder_pickings:
             for move in bo_picking.move_ids:
-                if move.state not in ('confirmed', 'partially_available', 'waiting', 'assigned'):
+                if move.state not in _BACKORDER_STATES:
                     continue
                 try:
-                    strategy = move._get_whole_lot_strategy_type()
+                    strategy = move._get_whole_lot_strategy_type(cache=strategy_cache)
                     if not strategy:
                         continue
                 except Exception:
@@ -90,43 +172,55 @@ class StockPicking(models.Model):
 
                 product = move.product_id
                 rounding = product.uom_id.rounding
+                # Comparación directa contra medio redondeo: equivale a
+                # float_compare(x, 0) sin el costo de la llamada por lote.
+                eps = rounding / 2.0
                 sol = move.sale_line_id
                 if not sol:
                     continue
 
-                selection = move._get_sol_lot_selection(sol)
-                all_so_lot_ids = selection['lot_ids']
-                breakdown = selection['breakdown']
-
-                if not all_so_lot_ids:
-                    continue
-
-                existing_so_lots = self.env['stock.lot'].browse(list(all_so_lot_ids)).exists()
-                removed_ids = all_so_lot_ids - set(existing_so_lots.ids)
-                if removed_ids:
-                    _logger.warning(
-                        "WholeLot: Filtered out %d non-existent lot IDs: %s",
-                        len(removed_ids), list(removed_ids)
+                # Selección de lotes y validación de existencia resueltas
+                # una vez por SO line (varios moves del backorder comparten
+                # la misma línea).
+                cached_selection = selection_cache.get(sol.id)
+                if cached_selection is None:
+                    selection = move._get_sol_lot_selection(sol)
+                    so_lot_ids = selection['lot_ids']
+                    if so_lot_ids:
+                        existing_so_lots = self.env['stock.lot'].browse(
+                            list(so_lot_ids)
+                        ).exists()
+                        removed_ids = so_lot_ids - set(existing_so_lots._ids)
+                        if removed_ids:
+                            _logger.warning(
+                                "WholeLot: Filtered out %d non-existent lot IDs: %s",
+                                len(removed_ids), list(removed_ids)
+                            )
+                            so_lot_ids = set(existing_so_lots._ids)
+                    cached_selection = selection_cache[sol.id] = (
+                        so_lot_ids, selection['breakdown']
                     )
-                    all_so_lot_ids = set(existing_so_lots.ids)
+                all_so_lot_ids, breakdown = cached_selection
 
                 if not all_so_lot_ids:
                     continue
 
-                all_delivered_ids = set()
-                done_moves = sol.move_ids.filtered(lambda m: m.state == 'done')
-                for dm in done_moves:
-                    for ml in dm.move_line_ids:
-                        if ml.lot_id:
-                            all_delivered_ids.add(ml.lot_id.id)
+                # Lotes entregados resueltos una vez por SO line vía el
+                # helper compartido (varios moves del backorder suelen
+                # apuntar a la misma línea).
+                all_delivered_ids = delivered_cache.get(sol.id)
+                if all_delivered_ids is None:
+                    all_delivered_ids = delivered_cache[sol.id] = \
+                        Move._get_already_delivered_lot_ids(sol)
 
                 pending_lot_ids = all_so_lot_ids - all_delivered_ids
 
-                _logger.info(
-                    "WholeLot[%s]: Backorder %s move %d - SO: %s, Delivered: %s, Pending: %s",
-                    strategy, bo_picking.name, move.id,
-                    list(all_so_lot_ids), list(all_delivered_ids), list(pending_lot_ids)
-                )
+                if _logger.isEnabledFor(logging.DEBUG):
+                    _logger.debug(
+                        "WholeLot[%s]: Backorder %s move %d - SO: %s, Delivered: %s, Pending: %s",
+                        strategy, bo_picking.name, move.id,
+                        list(all_so_lot_ids), list(all_delivered_ids), list(pending_lot_ids)
+                    )
 
                 if not pending_lot_ids:
                     continue
@@ -138,42 +232,90 @@ class StockPicking(models.Model):
                     if strategy == 'whole_lot_partial' and breakdown:
                         qtys_match = all(
                             float_compare(
-                                ml.quantity if 'quantity' in ml._fields else 0.0,
+                                ml.quantity if ml_has_quantity else 0.0,
                                 breakdown.get(ml.lot_id.id, 0.0),
                                 precision_rounding=rounding
                             ) == 0
                             for ml in move.move_line_ids if ml.lot_id
                         )
                         if qtys_match:
-                            _logger.info("WholeLot: Backorder already has correct lots+qtys, skipping")
+                            _logger.debug("WholeLot: Backorder already has correct lots+qtys, skipping")
                             continue
                     else:
-                        _logger.info("WholeLot: Backorder already has correct lots, skipping")
+                        _logger.debug("WholeLot: Backorder already has correct lots, skipping")
                         continue
 
                 if move.move_line_ids:
                     _logger.info(
                         "WholeLot: Clearing %d incorrect move_lines", len(move.move_line_ids)
                     )
-                    for ml in move.move_line_ids:
-                        ml_qty = ml.quantity if 'quantity' in ml._fields else 0.0
-                        if ml_qty > 0 and ml.lot_id:
-                            try:
-                                Quant._update_reserved_quantity(
-                                    product, move.location_id, -ml_qty,
-                                    lot_id=ml.lot_id, strict=False
-                                )
-                            except Exception:
-                                pass
+                    # Des-reserva agregada por lote: un solo
+                    # _update_reserved_quantity por lote distinto en lugar
+                    # de uno por línea.
+                    to_unreserve = {}
+                    if ml_has_quantity:
+                        for ml in move.move_line_ids:
+                            if ml.lot_id and ml.quantity > 0:
+                                to_unreserve[ml.lot_id] = \
+                                    to_unreserve.get(ml.lot_id, 0.0) + ml.quantity
+                    for unres_lot, unres_qty in to_unreserve.items():
+                        try:
+                            Quant._update_reserved_quantity(
+                                product, move.location_id, -unres_qty,
+                                lot_id=unres_lot, strict=False
+                            )
+                        except Exception:
+                            pass
                     move.move_line_ids.unlink()
 
                 pending_lots = self.env['stock.lot'].browse(list(pending_lot_ids)).exists()
                 total_reserved = 0.0
+                assigned_pairs = []
+
+                # Factor de conversión a UoM del move resuelto una vez por
+                # move (identidad en el caso común): una multiplicación por
+                # lote en lugar de un _compute_quantity por lote.
+                if move.product_uom == product.uom_id:
+                    uom_factor = None
+                else:
+                    uom_factor = product.uom_id._compute_quantity(
+                        1.0, move.product_uom, round=False
+                    )
+                    uom_rounding = move.product_uom.rounding
+
+                # Totales por lote agregados en SQL: evita sumar quant por
+                # quant en Python dentro del loop (un lote puede tener muchos
+                # quants por paquete/propietario).
+                base_domain = [
+                    ('product_id', '=', product.id),
+                    ('location_id', 'child_of', move.location_id.id),
+                    ('lot_id', 'in', pending_lots._ids),
+                ]
+                totals_by_lot = {
+                    lot_rec.id: (qty_sum or 0.0, reserved_sum or 0.0)
+                    for lot_rec, qty_sum, reserved_sum in Quant._read_group(
+                        base_domain, ['lot_id'],
+                        ['quantity:sum', 'reserved_quantity:sum'],
+                    )
+                }
+                real_by_lot = {
+                    lot_rec.id: qty_sum or 0.0
+                    for lot_rec, qty_sum in Quant._read_group(
+                        base_domain + [('quantity', '>', 0)],
+                        ['lot_id'], ['quantity:sum'],
+                    )
+                }
+
+                # Un solo _gather para todos los lotes pendientes, agrupado en
+                # Python: evita una query por lote (solo se usa para resolver
+                # paquete/propietario de la línea creada).
+                quants_by_lot = {}
+                for quant in Quant._gather(product, move.location_id, strict=False):
+                    if quant.lot_id:
+                        quants_by_lot.setdefault(quant.lot_id.id, []).append(quant)
 
                 for lot in pending_lots:
-                    quants = Quant._gather(
-                        product, move.location_id, lot_id=lot, strict=False
-                    )
+                    quants = quants_by_lot.get(lot.id)
 
                     if not quants:
                         _logger.warning(
@@ -182,13 +324,11 @@ class StockPicking(models.Model):
                         )
                         continue
 
-                    lot_total_qty = sum(q.quantity for q in quants)
-                    lot_reserved_qty = sum(q.reserved_quantity for q in quants)
+                    lot_total_qty, lot_reserved_qty = totals_by_lot.get(lot.id, (0.0, 0.0))
                     lot_available_qty = lot_total_qty - lot_reserved_qty
-                    positive_quants = quants.filtered(lambda q: q.quantity > 0)
-                    lot_real_qty = sum(q.quantity for q in positive_quants) if positive_quants else 0.0
+                    lot_real_qty = real_by_lot.get(lot.id, 0.0)
 
-                    _logger.info(
+                    _logger.debug(
                         "WholeLot: Lot %s - total: %.2f, reserved: %.2f, available: %.2f, real_qty: %.2f",
                         lot.name, lot_total_qty, lot_reserved_qty,
                         lot_available_qty, lot_real_qty
@@ -198,16 +338,16 @@ class StockPicking(models.Model):
                         desired_qty = breakdown[lot.id]
                         max_available = max(lot_real_qty, lot_total_qty, lot_reserved_qty)
                         reserve_qty = min(desired_qty, max_available)
-                        _logger.info(
+                        _logger.debug(
                             "WholeLot[partial]: Lot %s - breakdown says %.2f, reserving %.2f",
                             lot.name, desired_qty, reserve_qty
                         )
                     else:
-                        if float_compare(lot_real_qty, 0, precision_rounding=rounding) > 0:
+                        if lot_real_qty > eps:
                             reserve_qty = lot_real_qty
-                        elif float_compare(lot_total_qty, 0, precision_rounding=rounding) > 0:
+                        elif lot_total_qty > eps:
                             reserve_qty = lot_total_qty
-                        elif float_compare(lot_reserved_qty, 0, precision_rounding=rounding) > 0:
+                        elif lot_reserved_qty > eps:
                             reserve_qty = lot_reserved_qty
                         else:
                             _logger.warning(
@@ -215,10 +355,10 @@ class StockPicking(models.Model):
                             )
                             continue
 
-                    if float_compare(reserve_qty, 0, precision_rounding=rounding) <= 0:
+                    if reserve_qty <= eps:
                         continue
 
-                    if float_compare(lot_available_qty, 0, precision_rounding=rounding) > 0:
+                    if lot_available_qty > eps:
                         try:
                             qty_to_reserve = min(reserve_qty, lot_available_qty)
                             Quant._update_reserved_quantity(
@@ -229,13 +369,18 @@ class StockPicking(models.Model):
                             _logger.error("WholeLot: Failed to reserve lot %s: %s", lot.name, e)
                             continue
                     else:
-                        _logger.info(
+                        _logger.debug(
                             "WholeLot: Lot %s already reserved (backorder transfer)", lot.name
                         )
 
-                    uom_qty = product.uom_id._compute_quantity(
-                        reserve_qty, move.product_uom, rounding_method='HALF-UP'
-                    )
+                    if uom_factor is None:
+                        uom_qty = reserve_qty
+                    else:
+                        uom_qty = float_round(
+                            reserve_qty * uom_factor,
+                            precision_rounding=uom_rounding,
+                            rounding_method='HALF-UP',
+                        )
 
                     ml_vals = {
                         'move_id': move.id,
@@ -249,10 +394,7 @@ class StockPicking(models.Model):
                         'company_id': move.company_id.id or self.env.company.id,
                     }
 
-                    if 'reserved_uom_qty' in self.env['stock.move.line']._fields:
-                        ml_vals['reserved_uom_qty'] = uom_qty
-                    else:
-                        ml_vals['quantity'] = uom_qty
+                    ml_vals[ml_qty_field] = uom_qty
 
                     first_quant = quants[0]
                     if first_quant.package_id:
@@ -260,27 +402,41 @@ class StockPicking(models.Model):
                     if first_quant.owner_id:
                         ml_vals['owner_id'] = first_quant.owner_id.id
 
-                    self.env['stock.move.line'].create(ml_vals)
+                    ml_vals_list.append(ml_vals)
+                    assigned_pairs.append((lot.name, uom_qty))
                     total_reserved += reserve_qty
 
-                    _logger.info(
-                        "WholeLot[%s]: SUCCESS - Assigned lot '%s' (%.2f %s) to backorder %s",
+                    _logger.debug(
+                        "WholeLot[%s]: Assigned lot '%s' (%.2f %s) to backorder %s",
                         strategy, lot.name, reserve_qty, product.uom_id.name, bo_picking.name
                     )
 
-                if float_compare(total_reserved, 0, precision_rounding=rounding) > 0:
-                    total_demand = move.product_uom._compute_quantity(
-                        move.product_uom_qty, product.uom_id,
-                        rounding_method='HALF-UP'
-                    )
+                if total_reserved > eps:
+                    if move.product_uom == product.uom_id:
+                        total_demand = move.product_uom_qty
+                    else:
+                        total_demand = move.product_uom._compute_quantity(
+                            move.product_uom_qty, product.uom_id,
+                            rounding_method='HALF-UP'
+                        )
                     if float_compare(total_reserved, total_demand, precision_rounding=rounding) >= 0:
-                        move.write({'state': 'assigned'})
+                        to_assigned_ids.append(move.id)
                     else:
-                        move.write({'state': 'partially_available'})
+                        to_partial_ids.append(move.id)
 
-                _logger.info(
-                    "WholeLot: Backorder move %d final: state=%s, lots=%s",
-                    move.id, move.state,
-                    [(ml.lot_id.name, ml.quantity)
-                     for ml in move.move_line_ids if ml.lot_id]
+                _logger.debug(
+                    "WholeLot: Backorder move %d assigned lots=%s",
+                    move.id, assigned_pairs
                 )
+
+        if ml_vals_list:
+            self.env['stock.move.line'].create(ml_vals_list)
+        if to_assigned_ids:
+            self.env['stock.move'].browse(to_assigned_ids).write({'state': 'assigned'})
+        if to_partial_ids:
+            self.env['stock.move'].browse(to_partial_ids).write({'state': 'partially_available'})
+        if to_assigned_ids or to_partial_ids:
+            _logger.info(
+                "WholeLot: Backorder states updated - assigned=%s, partial=%s",
+                to_assigned_ids, to_partial_ids
+            )
@@ -2,6 +2,7 @@
 import logging
 from odoo import models, api
 from odoo.tools import float_compare, float_is_zero
+from odoo.tools.sql import create_index
 
 _logger = logging.getLogger(__name__)
 
@@ -9,6 +10,19 @@ _logger = logging.getLogger(__name__)
 class StockQuant(models.Model):
     _inherit = 'stock.quant'
 
+    def init(self):
+        super().init()
+        # Las estrategias whole_lot* filtran repetidamente quants por
+        # (producto, ubicación, lote) con cantidad positiva; el índice
+        # parcial mantiene esos lookups como Index Scan en DBs grandes.
+        create_index(
+            self._cr,
+            'stock_quant_whole_lot_idx',
+            self._table,
+            ['product_id', 'location_id', 'lot_id'],
+            where='quantity > 0 AND lot_id IS NOT NULL',
+        )
+
     @api.model
     def _get_removal_strategy_order(self, removal_strategy):
         """Extend to handle 'whole_lot' and 'whole_lot_partial' removal strategies."""
@@ -16,35 +30,38 @@ class StockQuant(models.Model):
             return 'in_date ASC NULLS FIRST, id ASC'
         return super()._get_removal_strategy_order(removal_strategy)
 
-    @api.model
-    def _get_removal_strategy(self, product_id, location_id):
-        result = super()._get_removal_strategy(product_id, location_id)
-        return result
-
     def _get_whole_lot_available_quants(self, product_id, location_id, lot_id=None,
                                          package_id=None, owner_id=None, strict=False):
         """Get all quants grouped by lot with their available quantities (FIFO)."""
         quants = self._gather(product_id, location_id, lot_id=lot_id,
                               package_id=package_id, owner_id=owner_id, strict=strict)
+        # Cargar explícitamente los campos que consume la agregación: el
+        # primer acceso del loop no dispara un fetch ancho de la tabla.
+        quants.fetch(['quantity', 'reserved_quantity', 'lot_id', 'in_date'])
 
         lot_data = {}
         rounding = product_id.uom_id.rounding
 
+        # Una sola pasada sobre los quants; los ids se acumulan en listas y
+        # el recordset por lote se materializa al final (la unión |= por
+        # quant reconstruye el recordset en cada paso).
         for quant in quants:
             lot_key = quant.lot_id.id or False
-            if lot_key not in lot_data:
-                lot_data[lot_key] = {
+            data = lot_data.get(lot_key)
+            if data is None:
+                data = lot_data[lot_key] = {
                     'lot_id': quant.lot_id,
                     'available_qty': 0.0,
-                    'quants': self.env['stock.quant'],
+                    'quant_ids': [],
                     'in_date': quant.in_date,
                 }
-            lot_data[lot_key]['available_qty'] += quant.quantity - quant.reserved_quantity
-            lot_data[lot_key]['quants'] |= quant
+            data['available_qty'] += quant.quantity - quant.reserved_quantity
+            data['quant_ids'].append(quant.id)
 
         available_lots = []
-        for lot_key, data in lot_data.items():
+        for data in lot_data.values():
             if float_compare(data['available_qty'], 0, precision_rounding=rounding) > 0:
+                data['quants'] = self.browse(data.pop('quant_ids'))
                 available_lots.append(data)
 
         available_lots.sort(key=lambda x: (x['in_date'] or ''))
@@ -52,35 +69,78 @@ class StockQuant(models.Model):
 
     @api.model
     def _whole_lot_select_lots(self, available_lots, need, rounding):
-        """Select which complete lots to reserve to fulfill the demand ('whole_lot' method only)."""
+        """Select which complete lots to reserve to fulfill the demand ('whole_lot' method only).
+
+        Las cantidades se escalan una vez a enteros (unidades de redondeo):
+        las comparaciones del escaneo pasan a ser aritmética entera en vez de
+        una llamada a float_compare por candidato, y el match exacto se
+        resuelve con un dict en O(N). El orden FIFO de los candidatos se
+        respeta igual que antes.
+        """
         if not available_lots:
             return []
 
-        for lot_data in available_lots:
-            if float_compare(lot_data['available_qty'], need, precision_rounding=rounding) == 0:
-                return [lot_data]
+        need_scaled = int(round(need / rounding))
+
+        # Caso dominante (propagaciones y backorders suelen traer un solo
+        # lote candidato): resolver sin montar las listas escaladas.
+        if len(available_lots) == 1:
+            only_scaled = int(round(available_lots[0]['available_qty'] / rounding))
+            return [available_lots[0]] if only_scaled <= need_scaled else []
+
+        scaled = [int(round(d['available_qty'] / rounding)) for d in available_lots]
+
+        # Etapa exacta: DP de sumas alcanzables acotada por la demanda.
+        # Encuentra combinaciones exactas de varios lotes que el escaneo
+        # voraz no ve (incluye el match de un solo lote como caso trivial).
+        # Recorrer en orden FIFO y conservar la primera máscara por suma
+        # hace que gane la combinación con los lotes más antiguos. El corte
+        # por tamaño mantiene el costo acotado con demandas muy granulares.
+        n = len(available_lots)
+        if n <= 24 and need_scaled > 0:
+            reachable = {0: 0}  # suma escalada -> bitmask de índices
+            for idx, qty in enumerate(scaled):
+                if qty <= 0 or qty > need_scaled:
+                    continue
+                bit = 1 << idx
+                updates = {}
+                for partial_sum, mask in reachable.items():
+                    new_sum = partial_sum + qty
+                    if new_sum <= need_scaled and new_sum not in reachable \
+                            and new_sum not in updates:
+                        updates[new_sum] = mask | bit
+                reachable.update(updates)
+                if need_scaled in reachable or len(reachable) > 100000:
+                    break
+            exact_mask = reachable.get(need_scaled)
+            if exact_mask is not None:
+                return [available_lots[idx] for idx in range(n)
+                        if exact_mask & (1 << idx)]
+        else:
+            # Con muchos candidatos la DP no corre: conservar al menos el
+            # match exacto de un solo lote antes del escaneo voraz.
+            for idx, qty in enumerate(scaled):
+                if qty == need_scaled:
+                    return [available_lots[idx]]
 
         selected = []
-        remaining_need = need
-
-        for lot_data in available_lots:
-            lot_qty = lot_data['available_qty']
-            cmp = float_compare(lot_qty, remaining_need, precision_rounding=rounding)
-            if cmp <= 0:
-                selected.append(lot_data)
-                remaining_need -= lot_qty
-                if float_is_zero(remaining_need, precision_rounding=rounding):
+        selected_idx = set()
+        remaining = need_scaled
+
+        for idx, qty in enumerate(scaled):
+            if qty <= remaining:
+                selected.append(available_lots[idx])
+                selected_idx.add(idx)
+                remaining -= qty
+                if remaining == 0:
                     break
 
-        if float_compare(remaining_need, 0, precision_rounding=rounding) > 0:
-            selected_lot_ids = {d['lot_id'].id for d in selected}
-            for lot_data in available_lots:
-                if lot_data['lot_id'].id in selected_lot_ids:
-                    continue
-                if float_compare(lot_data['available_qty'], remaining_need,
-                                 precision_rounding=rounding) == 0:
-                    selected.append(lot_data)
-                    remaining_need = 0
+        if remaining > 0:
+            # Un lote no seleccionado que cierre exactamente lo pendiente.
+            for idx, qty in enumerate(scaled):
+                if idx not in selected_idx and qty == remaining:
+                    selected.append(available_lots[idx])
+                    remaining = 0
                     break
 
         return selected